@@ -3,8 +3,11 @@ This module contains the agatesql extensions to
 :class:`Table <agate.table.Table>`.
 """
 
+import contextlib
 import datetime
 import decimal
+import os
+import tempfile
 from urllib.parse import urlsplit
 
 import agate
@@ -44,16 +47,136 @@ INTERVAL_MAP = {
     'oracle': ORACLE_INTERVAL,
 }
 
+#: PRAGMA statements that speed up loading data into SQLite. These can be set
+#: and restored inside a transaction, so :func:`to_sql` can apply them to a
+#: caller's connection and restore them afterward.
+#: @see https://www.sqlite.org/pragma.html
+SQLITE_BULK_LOAD_PRAGMAS = {
+    'cache_size': -64000,  # 64 MiB
+    'temp_store': 'MEMORY',
+}
+
+#: PRAGMA statements for the scratch SQLite databases created by agatesql,
+#: which have nothing to recover after a crash.
+SQLITE_SCRATCH_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+}
+
+#: PRAGMA statements for the temporary SQLite database to which
+#: :func:`sql_query` spills large tables. Temporary tables and indices go to
+#: disk, too, and reads are memory-mapped.
+SQLITE_DISK_PRAGMAS = {
+    'temp_store': 'FILE',
+    'mmap_size': 268435456,  # 256 MiB
+}
+
+#: The number of cells above which ``sql_query(storage='auto')`` uses disk.
+SQL_QUERY_DISK_THRESHOLD = 10000000
+
+
+def set_sqlite_pragmas(connection, pragmas):
+    """
+    Sets PRAGMA statements on a SQLite connection.
+
+    :param connection:
+        An existing sqlalchemy connection to a SQLite database.
+    :param pragmas:
+        A dict of PRAGMA names and values, like :data:`SQLITE_BULK_LOAD_PRAGMAS`.
+    """
+    for name, value in pragmas.items():
+        connection.exec_driver_sql('PRAGMA %s = %s' % (name, value))
+
+
+class NativeNumber(agate.Number):
+    """
+    A :class:`agate.Number <agate.data_types.Number>` that keeps integers and
+    floats as they are, instead of casting them to :class:`decimal.Decimal`.
+
+    This uses less memory, but these agate features raise errors on such
+    columns: the :class:`agate.MaxPrecision`, :class:`agate.StDev` and
+    :class:`agate.PopulationStDev` aggregations; the ``print_table``,
+    ``print_bars`` and ``print_html`` methods; using the column for row names,
+    as ``pivot`` and ``denormalize`` do; and arithmetic between float and
+    :class:`decimal.Decimal` values, as in computations across a
+    :class:`NativeNumber` column and a :class:`agate.Number` column.
+    """
+    def cast(self, d):
+        if type(d) is int or type(d) is float:
+            return d
+
+        return super().cast(d)
+
+
+class SQLQueryBatches:
+    """
+    An iterator of agate tables, read in batches from the results of
+    :func:`sql_query`. Every table has the given column types.
+
+    The connection is closed, and any temporary database file deleted, when
+    the iterator is exhausted, closed or garbage collected.
+
+    :param rows:
+        A sqlalchemy result.
+    :param batch_size:
+        The maximum number of rows in each table.
+    :param column_types:
+        A sequence of column types.
+    :param close:
+        A function that closes the connection.
+    """
+    def __init__(self, rows, batch_size, column_types, close):
+        self._close = close
+        self._rows = rows
+        self._batch_size = batch_size
+        self._column_names = tuple(rows.keys())
+        self._column_types = column_types
+        self._yielded = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._close is None:
+            raise StopIteration
+
+        batch = self._rows.fetchmany(self._batch_size)
+
+        if not batch:
+            yielded = self._yielded
+            self.close()
+            # Like the non-batched path, return at least one table, to provide the column names.
+            if yielded:
+                raise StopIteration
+
+        self._yielded = True
+
+        return agate.Table(batch, self._column_names, self._column_types)
+
+    def close(self):
+        """
+        Close the connection and delete any temporary database file.
+        """
+        if self._close is not None:
+            close, self._close = self._close, None
+            close()
+
+    def __del__(self):
+        self.close()
+
 
 def get_engine_and_connection(connection_or_string=None):
     """
     Gets a connection to a specific SQL alchemy backend. If an existing
     connection is provided, it will be passed through. If no connection
-    string is provided, then in in-memory SQLite database will be created.
+    string is provided, then in in-memory SQLite database will be created,
+    with :data:`SQLITE_BULK_LOAD_PRAGMAS` and :data:`SQLITE_SCRATCH_PRAGMAS`
+    applied.
     """
     if connection_or_string is None:
         engine = create_engine('sqlite:///:memory:')
         connection = engine.connect()
+        set_sqlite_pragmas(connection, {**SQLITE_BULK_LOAD_PRAGMAS, **SQLITE_SCRATCH_PRAGMAS})
         return None, connection
     if isinstance(connection_or_string, Connection):
         connection = connection_or_string
@@ -68,7 +191,7 @@ def get_engine_and_connection(connection_or_string=None):
     return engine, connection
 
 
-def from_sql(cls, connection_or_string, table_name):
+def from_sql(cls, connection_or_string, table_name, native_numbers=False, chunk_size=None):
     """
     Create a new :class:`agate.Table` from a given SQL table. Types will be
     inferred from the database schema.
@@ -79,6 +202,13 @@ def from_sql(cls, connection_or_string, table_name):
         An existing sqlalchemy connection or connection string.
     :param table_name:
         The name of a table in the referenced database.
+    :param native_numbers:
+        Use :class:`NativeNumber` for integer and float columns, to keep their
+        values as :class:`int` and :class:`float` instead of
+        :class:`decimal.Decimal`.
+    :param chunk_size:
+        Stream rows from the database in batches of this size, instead of
+        letting the driver buffer the whole result.
     """
     engine, connection = get_engine_and_connection(connection_or_string)
 
@@ -96,7 +226,9 @@ def from_sql(cls, connection_or_string, table_name):
         else:
             py_type = sql_column.type.python_type
 
-        if py_type in [int, float, decimal.Decimal]:
+        if py_type in [int, float] and native_numbers:
+            column_types.append(NativeNumber())
+        elif py_type in [int, float, decimal.Decimal]:
             if py_type is float:
                 sql_column.type.asdecimal = True
             column_types.append(agate.Number())
@@ -115,7 +247,12 @@ def from_sql(cls, connection_or_string, table_name):
 
     s = select(sql_table)
 
-    rows = connection.execute(s)
+    if chunk_size is None:
+        rows = connection.execute(s)
+    else:
+        # Use a server-side cursor, if the driver supports it, so that partitions come from fetchmany.
+        rows = connection.execution_options(stream_results=True).execute(s)
+        rows = (tuple(row) for partition in rows.partitions(chunk_size) for row in partition)
 
     try:
         return agate.Table(rows, column_names, column_types)
@@ -222,7 +359,12 @@ def make_sql_table(table, table_name, dialect=None, db_schema=None, constraints=
                 # SQL Server has range 1-38 and default 18, scale default 0.
                 # @see https://docs.microsoft.com/en-us/sql/t-sql/data-types/decimal-and-numeric-transact-sql
                 sql_type_kwargs['precision'] = 38
-                sql_type_kwargs['scale'] = table.aggregate(agate.MaxPrecision(column_name))
+                if isinstance(column.data_type, NativeNumber):
+                    # MaxPrecision expects Decimal values.
+                    values = [decimal.Decimal(str(value)) for value in column.values_without_nulls()]
+                    sql_type_kwargs['scale'] = agate.utils.max_precision(values)
+                else:
+                    sql_type_kwargs['scale'] = table.aggregate(agate.MaxPrecision(column_name))
 
             # Avoid errors due to NO_ZERO_DATE.
             # @see https://dev.mysql.com/doc/refman/8.2/en/sql-mode.html#sqlmode_no_zero_date
@@ -241,7 +383,7 @@ def make_sql_table(table, table_name, dialect=None, db_schema=None, constraints=
 def to_sql(self, connection_or_string, table_name, overwrite=False,
            create=True, create_if_not_exists=False, insert=True, prefixes=[],
            db_schema=None, constraints=True, unique_constraint=[], chunk_size=None,
-           min_col_len=1, col_len_multiplier=1):
+           min_col_len=1, col_len_multiplier=1, bulk_load=False):
     """
     Write this table to the given SQL database.
 
@@ -273,6 +415,11 @@ def to_sql(self, connection_or_string, table_name, overwrite=False,
         The minimum length of text columns.
     :param col_len_multiplier:
         Multiply the maximum column length by this multiplier to accomodate larger values in later runs.
+    :param bulk_load:
+        If the database is SQLite, apply :data:`SQLITE_BULK_LOAD_PRAGMAS` to
+        the connection while writing, and restore the previous values after.
+        This helps most when inserting into indexes larger than SQLite's default
+        cache, like a unique constraint on unsorted values.
     """
     engine, connection = get_engine_and_connection(connection_or_string)
 
@@ -281,26 +428,40 @@ def to_sql(self, connection_or_string, table_name, overwrite=False,
                                unique_constraint=unique_constraint, connection=connection,
                                min_col_len=min_col_len, col_len_multiplier=col_len_multiplier)
 
-    if create:
-        if overwrite:
-            sql_table.drop(bind=connection, checkfirst=True)
+    previous_pragmas = {}
+    if bulk_load and dialect == 'sqlite':
+        for name in SQLITE_BULK_LOAD_PRAGMAS:
+            previous_pragmas[name] = connection.exec_driver_sql('PRAGMA %s' % name).scalar()
+        set_sqlite_pragmas(connection, SQLITE_BULK_LOAD_PRAGMAS)
 
-        sql_table.create(bind=connection, checkfirst=create_if_not_exists)
-
-    if insert:
-        insert = sql_table.insert()
-        for prefix in prefixes:
-            insert = insert.prefix_with(prefix)
-        if chunk_size is None:
-            connection.execute(insert, [dict(zip(self.column_names, row)) for row in self.rows])
-        else:
-            number_of_rows = len(self.rows)
-            for index in range((number_of_rows - 1) // chunk_size + 1):
-                end_index = (index + 1) * chunk_size
-                if end_index > number_of_rows:
-                    end_index = number_of_rows
-                connection.execute(insert, [dict(zip(self.column_names, row)) for row in
-                                            self.rows[index * chunk_size:end_index]])
+    try:
+        if create:
+            if overwrite:
+                sql_table.drop(bind=connection, checkfirst=True)
+
+            sql_table.create(bind=connection, checkfirst=create_if_not_exists)
+
+        if insert:
+            insert = sql_table.insert()
+            for prefix in prefixes:
+                insert = insert.prefix_with(prefix)
+            if chunk_size is None:
+                connection.execute(insert, [dict(zip(self.column_names, row)) for row in self.rows])
+            else:
+                number_of_rows = len(self.rows)
+                for index in range((number_of_rows - 1) // chunk_size + 1):
+                    end_index = (index + 1) * chunk_size
+                    if end_index > number_of_rows:
+                        end_index = number_of_rows
+                    connection.execute(insert, [dict(zip(self.column_names, row)) for row in
+                                                self.rows[index * chunk_size:end_index]])
+    except Exception:
+        # Don't hide the original error if the pragmas can't be restored.
+        with contextlib.suppress(Exception):
+            set_sqlite_pragmas(connection, previous_pragmas)
+        raise
+
+    set_sqlite_pragmas(connection, previous_pragmas)
 
     try:
         return sql_table
@@ -337,10 +498,10 @@ def to_sql_create_statement(self, table_name, dialect=None, db_schema=None, cons
     return str(CreateTable(sql_table).compile(dialect=sql_dialect)).strip() + ';'
 
 
-def sql_query(self, query, table_name='agate'):
+def sql_query(self, query, table_name='agate', storage='memory', batch_size=None, column_types=None):
     """
-    Convert this agate table into an intermediate, in-memory sqlite table,
-    run a query against it, and then return the results as a new agate table.
+    Convert this agate table into an intermediate sqlite table, run a query
+    against it, and then return the results as a new agate table.
 
     Multiple queries may be separated with semicolons.
 
@@ -349,22 +510,76 @@ def sql_query(self, query, table_name='agate'):
         with semicolons.
     :param table_name:
         The name to use for the table in the queries, defaults to ``agate``.
+    :param storage:
+        Where to store the intermediate sqlite table: ``'memory'``, ``'disk'``
+        (a temporary file, deleted afterward) or ``'auto'`` (``'disk'`` if the
+        table has more than :data:`SQL_QUERY_DISK_THRESHOLD` cells).
+    :param batch_size:
+        If set, return a :class:`SQLQueryBatches` iterator of agate tables with
+        up to this many rows each, instead of a single table. Requires
+        ``column_types``.
+    :param column_types:
+        A sequence of column types for the results. If not set, column types
+        are inferred from the returned data.
     """
-    _, connection = get_engine_and_connection()
+    if batch_size is not None and column_types is None:
+        raise ValueError('column_types is required when batch_size is set.')
 
-    # Execute the specified SQL queries
-    queries = query.split(';')
-    rows = None
+    if storage == 'auto':
+        if len(self.rows) * len(self.column_names) > SQL_QUERY_DISK_THRESHOLD:
+            storage = 'disk'
+        else:
+            storage = 'memory'
 
-    self.to_sql(connection, table_name)
+    if storage not in ('memory', 'disk'):
+        raise ValueError('Unsupported storage: %s' % storage)
 
-    for q in queries:
-        if q:
-            rows = connection.exec_driver_sql(q)
+    path = None
+    connection = None
 
-    table = agate.Table(list(rows), column_names=rows._metadata.keys)
+    def close():
+        nonlocal connection, path
+        if connection is not None:
+            connection.close()
+            connection.engine.dispose()
+            connection = None
+        if path is not None:
+            os.remove(path)
+            path = None
 
-    return table
+    streaming = False
+
+    try:
+        if storage == 'memory':
+            _, connection = get_engine_and_connection()
+        else:
+            fd, path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            connection = create_engine('sqlite:///' + path).connect()
+            pragmas = {**SQLITE_BULK_LOAD_PRAGMAS, **SQLITE_SCRATCH_PRAGMAS, **SQLITE_DISK_PRAGMAS}
+            set_sqlite_pragmas(connection, pragmas)
+
+        # Execute the specified SQL queries
+        queries = query.split(';')
+        rows = None
+
+        self.to_sql(connection, table_name)
+
+        for q in queries:
+            if q:
+                rows = connection.exec_driver_sql(q)
+
+        if batch_size is not None:
+            batches = SQLQueryBatches(rows, batch_size, column_types, close)
+            streaming = True
+            return batches
+
+        table = agate.Table(list(rows), column_names=rows._metadata.keys, column_types=column_types)
+
+        return table
+    finally:
+        if not streaming:
+            close()
 
 
 agate.Table.from_sql = classmethod(from_sql)
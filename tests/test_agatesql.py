@@ -1,5 +1,9 @@
+import gc
+import os
+import tempfile
 from decimal import Decimal
 from textwrap import dedent
+from unittest import mock
 
 import agate
 from sqlalchemy import create_engine
@@ -47,6 +51,53 @@ class TestSQL(agate.AgateTestCase):
         self.assertEqual(len(table.rows), len(self.table.rows))
         self.assertSequenceEqual(table.rows[0], self.table.rows[0])
 
+    def test_native_numbers(self):
+        engine = create_engine(self.connection_string)
+        connection = engine.connect()
+
+        connection.exec_driver_sql('CREATE TABLE native_numbers_test (i INTEGER, f FLOAT, n NUMERIC(10, 2))')
+        connection.exec_driver_sql('INSERT INTO native_numbers_test VALUES (1, 1.5, 2.25), (NULL, NULL, NULL)')
+
+        table = agate.Table.from_sql(connection, 'native_numbers_test', native_numbers=True)
+
+        self.assertIsInstance(table.column_types[0], agatesql.table.NativeNumber)
+        self.assertIsInstance(table.column_types[1], agatesql.table.NativeNumber)
+        self.assertNotIsInstance(table.column_types[2], agatesql.table.NativeNumber)
+        self.assertIs(type(table.rows[0][0]), int)
+        self.assertIs(type(table.rows[0][1]), float)
+        self.assertIs(type(table.rows[0][2]), Decimal)
+        self.assertSequenceEqual(table.rows[0], (1, 1.5, Decimal('2.25')))
+        self.assertSequenceEqual(table.rows[1], (None, None, None))
+
+    def test_native_numbers_create_statement(self):
+        engine = create_engine(self.connection_string)
+        connection = engine.connect()
+
+        connection.exec_driver_sql('CREATE TABLE native_numbers_test (i INTEGER NOT NULL, f FLOAT NOT NULL)')
+        connection.exec_driver_sql('INSERT INTO native_numbers_test VALUES (1, 1.5), (2, 0.125)')
+
+        table = agate.Table.from_sql(connection, 'native_numbers_test', native_numbers=True)
+
+        statement = table.to_sql_create_statement('test_table', dialect='mysql')
+
+        self.assertEqual(statement.replace('\t', '  '), dedent('''\
+            CREATE TABLE test_table (
+              i DECIMAL(38, 0) NOT NULL, 
+              f DECIMAL(38, 3) NOT NULL
+            );'''))  # noqa: W291
+
+    def test_from_sql_chunk_size(self):
+        engine = create_engine(self.connection_string)
+        connection = engine.connect()
+
+        self.table.to_sql(connection, 'from_sql_chunk_size_test')
+
+        table = agate.Table.from_sql(connection, 'from_sql_chunk_size_test', chunk_size=3)
+
+        self.assertEqual(len(table.rows), len(self.table.rows))
+        self.assertSequenceEqual(table.rows[0], self.table.rows[0])
+        self.assertSequenceEqual(table.rows[3], self.table.rows[3])
+
     def test_create_if_not_exists(self):
         column_names = ['id', 'name']
         column_types = [agate.Number(), agate.Text()]
@@ -102,6 +153,70 @@ class TestSQL(agate.AgateTestCase):
         self.assertEqual(len(table.rows), len(self.table.rows) - 1)
         self.assertSequenceEqual(table.rows[1], self.table.rows[2])
 
+    def test_scratch_connection_pragmas(self):
+        _, connection = agatesql.table.get_engine_and_connection()
+
+        try:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'off')
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 0)
+            self.assertEqual(connection.exec_driver_sql('PRAGMA cache_size').scalar(), -64000)
+            self.assertEqual(connection.exec_driver_sql('PRAGMA temp_store').scalar(), 2)
+        finally:
+            connection.close()
+
+    def test_bulk_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine('sqlite:///' + os.path.join(directory, 'test.db'))
+            connection = engine.connect()
+
+            try:
+                self.table.to_sql(connection, 'bulk_load_test', bulk_load=True)
+
+                self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'delete')
+                self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 2)
+                self.assertEqual(connection.exec_driver_sql('PRAGMA cache_size').scalar(), -2000)
+                self.assertEqual(connection.exec_driver_sql('PRAGMA temp_store').scalar(), 0)
+
+                table = agate.Table.from_sql(connection, 'bulk_load_test')
+
+                self.assertEqual(len(table.rows), len(self.table.rows))
+                self.assertSequenceEqual(table.rows[0], self.table.rows[0])
+            finally:
+                connection.close()
+                engine.dispose()
+
+            self.assertEqual(os.listdir(directory), ['test.db'])
+
+    def test_bulk_load_error(self):
+        engine = create_engine(self.connection_string)
+        connection = engine.connect()
+
+        try:
+            with mock.patch('agatesql.table.set_sqlite_pragmas', side_effect=[None, RuntimeError]):
+                with self.assertRaises(IntegrityError):
+                    self.table.to_sql(connection, 'bulk_load_test', unique_constraint=['number'], bulk_load=True)
+        finally:
+            connection.close()
+            engine.dispose()
+
+    def test_bulk_load_in_transaction(self):
+        engine = create_engine(self.connection_string)
+        connection = engine.connect()
+
+        try:
+            self.table.to_sql(connection, 'bulk_load_test')
+            connection.exec_driver_sql("INSERT INTO bulk_load_test (textcol) VALUES ('d')")
+            self.assertTrue(connection.connection.dbapi_connection.in_transaction)
+
+            self.table.to_sql(connection, 'bulk_load_test', create=False, bulk_load=True)
+
+            self.assertEqual(connection.exec_driver_sql('PRAGMA cache_size').scalar(), -2000)
+            self.assertEqual(connection.exec_driver_sql('PRAGMA temp_store').scalar(), 0)
+            self.assertEqual(len(agate.Table.from_sql(connection, 'bulk_load_test').rows), 9)
+        finally:
+            connection.close()
+            engine.dispose()
+
     def test_to_sql_create_statement(self):
         statement = self.table.to_sql_create_statement('test_table')
 
@@ -252,6 +367,106 @@ class TestSQL(agate.AgateTestCase):
         self.assertColumnTypes(results, [agate.Number])
         self.assertRows(results, [[Decimal('5.123')]])
 
+    def test_sql_query_disk(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch('tempfile.tempdir', directory):
+            results = self.table.sql_query('select * from agate', storage='disk')
+
+            self.assertEqual(os.listdir(directory), [])
+
+        self.assertColumnNames(results, self.table.column_names)
+        self.assertRows(results, self.table.rows)
+
+    def test_sql_query_disk_error(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch('tempfile.tempdir', directory), \
+                mock.patch('agatesql.table.set_sqlite_pragmas', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.table.sql_query('select * from agate', storage='disk')
+
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_sql_query_auto(self):
+        with mock.patch('tempfile.mkstemp', wraps=tempfile.mkstemp) as mkstemp:
+            results = self.table.sql_query('select * from agate', storage='auto')
+
+            mkstemp.assert_not_called()
+
+        self.assertColumnNames(results, self.table.column_names)
+        self.assertRows(results, self.table.rows)
+
+    def test_sql_query_auto_disk(self):
+        with mock.patch('agatesql.table.SQL_QUERY_DISK_THRESHOLD', 10), \
+                mock.patch('tempfile.mkstemp', wraps=tempfile.mkstemp) as mkstemp:
+            results = self.table.sql_query('select * from agate', storage='auto')
+
+            mkstemp.assert_called_once()
+
+        self.assertColumnNames(results, self.table.column_names)
+        self.assertRows(results, self.table.rows)
+
+    def test_sql_query_invalid_storage(self):
+        with self.assertRaises(ValueError):
+            self.table.sql_query('select * from agate', storage='cloud')
+
+    def test_sql_query_batch_size(self):
+        for storage in ('memory', 'disk'):
+            results = list(self.table.sql_query('select * from agate', storage=storage, batch_size=3,
+                                                column_types=self.column_types))
+
+            self.assertEqual(len(results), 2)
+            self.assertColumnNames(results[0], self.table.column_names)
+            self.assertRows(results[0], self.table.rows[:3])
+            self.assertRows(results[1], self.table.rows[3:])
+
+    def test_sql_query_batch_size_requires_column_types(self):
+        with self.assertRaises(ValueError):
+            self.table.sql_query('select * from agate', batch_size=3)
+
+    def test_sql_query_batch_size_cleanup(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch('tempfile.tempdir', directory):
+            batches = self.table.sql_query('select * from agate', storage='disk', batch_size=3,
+                                           column_types=self.column_types)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            list(batches)
+            self.assertEqual(os.listdir(directory), [])
+
+            batches = self.table.sql_query('select * from agate', storage='disk', batch_size=3,
+                                           column_types=self.column_types)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            batches.close()
+            self.assertEqual(os.listdir(directory), [])
+            with self.assertRaises(StopIteration):
+                next(batches)
+
+            batches = self.table.sql_query('select * from agate', storage='disk', batch_size=3,
+                                           column_types=self.column_types)
+            self.assertEqual(len(os.listdir(directory)), 1)
+            del batches
+            gc.collect()
+            self.assertEqual(os.listdir(directory), [])
+
+    def test_sql_query_batch_size_mixed_values(self):
+        rows = (('1', '2020-01-01'), ('a', 'nope'))
+        table = agate.Table(rows, ['text', 'date'], [agate.Text(), agate.Text()])
+
+        results = list(table.sql_query('select * from agate', batch_size=1, column_types=table.column_types))
+
+        self.assertEqual(len(results), 2)
+        self.assertRows(results[0], [['1', '2020-01-01']])
+        self.assertRows(results[1], [['a', 'nope']])
+
+    def test_sql_query_batch_size_empty(self):
+        results = list(self.table.sql_query('select number, textcol from agate where 0', batch_size=2,
+                                            column_types=self.column_types[:2]))
+
+        self.assertEqual(len(results), 1)
+        self.assertColumnNames(results[0], ['number', 'textcol'])
+        self.assertRows(results[0], [])
+
+    def test_sql_query_column_types(self):
+        results = self.table.sql_query('select number from agate', column_types=[agate.Text()])
+
+        self.assertColumnTypes(results, [agate.Text])
+
     def test_chunk_size(self):
         column_names = ['number']
         column_types = [agate.Number()]